@@ -469,6 +469,15 @@ class Cluster {
         return ep;
     }
 
+    // add a list of endpoints already created with EndPoint.create, updating the load-balancer
+    // only once
+    addEndPoints(eps){
+        log.silly('Cluster.addEndPoints:', `cluster: ${this.name}:`, eps.map(e => e.name));
+        this.endpoints.push(...eps);
+        this.loadbalancer.update(this.endpoints);
+        return eps;
+    }
+
     getEndPoint(n){
         return this.endpoints.find( ({name}) => name === n );
     }
@@ -486,6 +495,14 @@ class Cluster {
         this.loadbalancer.update(this.endpoints);
     }
 
+    // delete a list of endpoints, updating the load-balancer only once
+    deleteEndPoints(ns){
+        log.silly('Cluster.deleteEndPoints:', `cluster: ${this.name}:`, 'names:', ns);
+        let names = new Set(ns);
+        this.endpoints = this.endpoints.filter(({name}) => !names.has(name));
+        this.loadbalancer.update(this.endpoints);
+    }
+
     virtualEndPoint(){
         return { name: this.name, spec: { address: '<VIRTUAL>' } };
     }
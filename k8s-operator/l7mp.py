@@ -28,9 +28,11 @@
 import asyncio
 import collections.abc
 import functools
+import hashlib
 import itertools
 import json
 import os
+import re
 import urllib3
 import yaml
 from copy import deepcopy
@@ -40,10 +42,40 @@ import kopf
 import l7mp_client
 from kopf._cogs.structs import bodies, dicts, diffs
 
+# Where the members of a service are learned from for matchService:
+# 'endpoints' (legacy v1/endpoints) or 'endpointslices'
+# (discovery.k8s.io/v1).
+ENDPOINTS_SOURCE = os.environ.get('L7MP_ENDPOINTS_SOURCE', 'endpoints')
+if ENDPOINTS_SOURCE not in ('endpoints', 'endpointslices'):
+    raise ValueError(f'Unknown L7MP_ENDPOINTS_SOURCE: "{ENDPOINTS_SOURCE}", '
+                     'expected "endpoints" or "endpointslices"')
+
+ZONE_LABEL = 'topology.kubernetes.io/zone'
+
+# Drift detection: seconds between two sweeps over the proxy pods (0
+# disables it), and the maximum number of pods checked per second.
+def get_env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        raise ValueError(f'{name} must be a number: "{os.environ[name]}"')
+
+DRIFT_CHECK_INTERVAL = get_env_float('L7MP_DRIFT_CHECK_INTERVAL', 300)
+DRIFT_CHECK_RATE = get_env_float('L7MP_DRIFT_CHECK_RATE', 5)
+if DRIFT_CHECK_INTERVAL < 0:
+    raise ValueError('L7MP_DRIFT_CHECK_INTERVAL must not be negative')
+if DRIFT_CHECK_RATE <= 0:
+    raise ValueError('L7MP_DRIFT_CHECK_RATE must be positive')
+
 # State of the k8s cluster
 s = {
     'pods': defaultdict(dict),
     'endpoints': defaultdict(dict),
+    # (namespace, service name) -> endpointslice fqn -> frozenset of
+    # ready pod uids
+    'services': defaultdict(dict),
+    # node name -> zone of the node
+    'nodes': {},
     'virtualservices': defaultdict(dict),
     'targets': defaultdict(dict),
     'rules': defaultdict(dict),
@@ -117,83 +149,205 @@ def get_target_extended_spec(s, target, logger):
     # 4.
     return spec
 
-def get_endpoint_groups(s, target, logger):
+def is_pod_ready(pod):
+    "Return True if POD is Ready and is not being deleted."
+    if pod['metadata'].get('deletionTimestamp'):
+        return False
+    for cond in pod['status'].get('conditions') or []:
+        if cond.get('type') == 'Ready':
+            return cond.get('status') == 'True'
+    return False
+
+def get_pod_locality(s, pod, locality):
+    "Return the node or the zone of POD depending on LOCALITY."
+    node = pod.get('spec', {}).get('nodeName')
+    if locality == 'Node' or not node:
+        return node
+    return s['nodes'].get(node)
+
+def get_endpoint_candidates(s, target, logger):
+    """Return the static endpoints of TARGET and the dynamic candidates.
+
+    Dynamic endpoints are generated for the ready pods matching an
+    endpoint selector, a candidate is a (name, endpoint, pod) tuple.
+
+    """
     try:
         endpoints = target['spec']['cluster']['endpoints']
     except KeyError:
-        return ([], {})
-    dynamic_eps = {}
+        return ([], [])
+    candidates = []
     static_eps = []
     for ep in endpoints:
         logger.debug('endpoint: %s', ep)
         if 'spec' in ep:
             static_eps.append(ep)
         elif 'selector' in ep:
-            for pod in iter_matching_pods(s, ep['selector'], s['pods']):
-                pod_ip = pod['status'].get('podIP')
-                if not pod_ip:
+            namespace = target['metadata']['namespace']
+            for ep_pod in iter_matching_pods(s, ep['selector'], s['pods'],
+                                             namespace):
+                pod_ip = ep_pod['status'].get('podIP')
+                if not pod_ip or not is_pod_ready(ep_pod):
                     continue
                 name = f'{get_fqn(target)}/{pod_ip}'
-                dynamic_eps[name] = {
+                candidates.append((name, {
                     'metadata': {'name': name},
                     'spec': {'address': pod_ip},
-                }
+                }, ep_pod))
         else:
             # This should have been catched by schema verification
             # earlier.
             logger.warning(f'Unknown endpoint spec: {ep}')
+    return static_eps, candidates
 
-    return static_eps, dynamic_eps
+def select_endpoints(s, target, candidates, pod=None):
+    """Return the static and the dynamic endpoints of TARGET for POD.
 
-def get_actions(s, logger):
-    "Return a list of actions that are necessary to execute to reach state S"
-    actions = defaultdict(dict)
-    for pod in s['pods'].values():
-        for vsvc in iter_matching(s, s['virtualservices'], pod):
-            actions[get_fqn(pod)][get_fqn(vsvc)] = {
-                 'type': 'vsvc',
-                 'name': get_fqn(vsvc),
-                 'spec': vsvc['spec'],
-            }
-        for target in s['targets'].values():
-            spec = get_target_extended_spec(s, target, logger)
-            if not spec:
-                continue
-            selector = spec['selector']
-            if not does_selector_match(s, selector, pod):
-                continue
-            etarget = dict(deepcopy(target))
-            etarget['spec'] = spec
-
-            s_eps, d_eps = get_endpoint_groups(s, etarget, logger)
-            etarget['spec']['cluster']['endpoints'] = s_eps
-            fqn_etarget = get_fqn(etarget)
-            actions[get_fqn(pod)][fqn_etarget] = {
-                 'type': 'target',
-                 'name': get_fqn(etarget),
-                 'spec': etarget['spec'],
-            }
-            for d_ep in d_eps.values():
-                ep_name = d_ep['metadata']['name']
-                actions[get_fqn(pod)][f'ep_{ep_name}'] = {
-                    'type': 'dynamic_endpoint',
-                    'name': ep_name,
-                    'spec': d_ep['spec'],
-                    'target': fqn_etarget,
-                }
-        for rule in iter_matching(s, s['rules'], pod):
-            actions[get_fqn(pod)][get_fqn(rule)] = {
-                 'type': 'rule',
-                 'name': get_fqn(rule),
-                 'spec': rule['spec'],
+    CANDIDATES is returned by get_endpoint_candidates().  If the
+    target has a locality set and POD is given, then only the
+    endpoints local to POD are returned, or all of them if none is
+    local.
+
+    """
+    static_eps, candidates = candidates
+    dynamic_eps = {name: ep for name, ep, _ in candidates}
+    locality = target['spec'].get('locality')
+    if not locality or not pod:
+        return static_eps, dynamic_eps
+    pod_locality = get_pod_locality(s, pod, locality)
+    if not pod_locality:
+        return static_eps, dynamic_eps
+    local_eps = {name: ep for name, ep, ep_pod in candidates
+                 if get_pod_locality(s, ep_pod, locality) == pod_locality}
+    return static_eps, local_eps or dynamic_eps
+
+def get_endpoint_groups(s, target, logger, pod=None):
+    "Return the static and the dynamic endpoints of TARGET for POD."
+    candidates = get_endpoint_candidates(s, target, logger)
+    return select_endpoints(s, target, candidates, pod)
+
+def get_referenced_services(spec, namespace):
+    """Return the services SPEC refers to in matchService selectors.
+
+    Services are identified by (namespace, name) pairs, where
+    NAMESPACE is the namespace of the object holding SPEC.
+
+    """
+    selectors = [spec.get('selector', {})]
+    for ep in spec.get('cluster', {}).get('endpoints', []):
+        selectors.append(ep.get('selector', {}))
+    return {(namespace, sel['matchService'])
+            for sel in selectors if 'matchService' in sel}
+
+def does_object_refer_to(obj, service):
+    "Return True if OBJ refers to SERVICE in a matchService selector."
+    namespace = obj['metadata']['namespace']
+    return service in get_referenced_services(obj['spec'], namespace)
+
+def get_action_plan(s, logger, service=None):
+    """Return the part of the actions for state S that is common to all pods.
+
+    If SERVICE, a (namespace, name) pair, is given, only objects
+    referring to SERVICE are considered.
+
+    """
+    vsvcs = s['virtualservices']
+    rules = s['rules']
+    if service:
+        vsvcs = {k: v for k, v in vsvcs.items()
+                 if does_object_refer_to(v, service)}
+        rules = {k: v for k, v in rules.items()
+                 if does_object_refer_to(v, service)}
+
+    # Extend the targets only once, not for every pod.
+    etargets = []
+    for target in s['targets'].values():
+        spec = get_target_extended_spec(s, target, logger)
+        if not spec:
+            continue
+        etarget = dict(target)
+        etarget['spec'] = spec
+        if service and not does_object_refer_to(etarget, service):
+            continue
+        candidates = get_endpoint_candidates(s, etarget, logger)
+        # Unless locality is set, the endpoints are the same for all
+        # pods.
+        if spec.get('locality'):
+            groups = None
+        else:
+            groups = select_endpoints(s, etarget, candidates)
+        etargets.append((etarget, candidates, groups))
+
+    return {'vsvcs': vsvcs, 'rules': rules, 'etargets': etargets}
+
+def get_pod_actions(s, plan, pod):
+    "Return the actions for POD, PLAN is returned by get_action_plan()."
+    actions = {}
+    for vsvc in iter_matching(s, plan['vsvcs'], pod):
+        actions[get_fqn(vsvc)] = {
+             'type': 'vsvc',
+             'name': get_fqn(vsvc),
+             'spec': vsvc['spec'],
+        }
+    for etarget, candidates, groups in plan['etargets']:
+        selector = etarget['spec']['selector']
+        namespace = etarget['metadata']['namespace']
+        if not does_selector_match(s, selector, pod, namespace):
+            continue
+
+        s_eps, d_eps = groups or select_endpoints(s, etarget, candidates,
+                                                  pod)
+        spec = dict(etarget['spec'])
+        spec['cluster'] = dict(spec['cluster'], endpoints=s_eps)
+        fqn_etarget = get_fqn(etarget)
+        actions[fqn_etarget] = {
+             'type': 'target',
+             'name': fqn_etarget,
+             'spec': spec,
+        }
+        for d_ep in d_eps.values():
+            ep_name = d_ep['metadata']['name']
+            actions[f'ep_{ep_name}'] = {
+                'type': 'dynamic_endpoint',
+                'name': ep_name,
+                'spec': d_ep['spec'],
+                'target': fqn_etarget,
             }
+    for rule in iter_matching(s, plan['rules'], pod):
+        actions[get_fqn(rule)] = {
+             'type': 'rule',
+             'name': get_fqn(rule),
+             'spec': rule['spec'],
+        }
+    return actions
+
+def get_actions(s, logger, service=None, pods=None):
+    """Return a list of actions that are necessary to execute to reach state S
 
+    If SERVICE, a (namespace, name) pair, is given, only objects
+    referring to SERVICE are considered.  If PODS is given, only
+    actions for PODS are returned.
 
+    """
+    plan = get_action_plan(s, logger, service=service)
+    actions = defaultdict(dict)
+    for pod in s['pods'].values() if pods is None else pods:
+        pod_actions = get_pod_actions(s, plan, pod)
+        if pod_actions:
+            actions[get_fqn(pod)] = pod_actions
     return actions
 
-async def update(s_old, s_new, logger=None, **kw):
-    a_old = get_actions(s_old, logger)
-    a_new = get_actions(s, logger)
+async def update(s_old, s_new, logger=None, service=None, direct=False,
+                 **kw):
+    """Push the changes between S_OLD and S_NEW to the proxies.
+
+    The changes are executed as kopf sub-handlers, unless DIRECT is
+    set.  Event handlers must set DIRECT, kopf.execute() is not
+    supported in them.
+
+    """
+    a_old = get_actions(s_old, logger, service=service)
+    a_new = get_actions(s_new, logger, service=service)
 
     # Create combined dict
     a_combined = {}
@@ -204,6 +358,8 @@ async def update(s_old, s_new, logger=None, **kw):
 
     fns = {}
     for pod_fqn, obj_fqns in a_combined.items():
+        # Dynamic endpoints are added/deleted in one batch per target.
+        ep_batches = defaultdict(lambda: ([], []))
         for fqn in obj_fqns:
             logger.debug(f'pod:{pod_fqn} obj_fqn:{fqn}')
             action_old = a_old.get(pod_fqn, {}).get(fqn, {})
@@ -225,7 +381,13 @@ async def update(s_old, s_new, logger=None, **kw):
                 cmd = 'change'
             else:
                 raise kopf.PermanentError('???')
-            if cmd:
+            if cmd and a_type == 'dynamic_endpoint':
+                target = action_new.get('target', action_old.get('target'))
+                if action_old:
+                    ep_batches[target][0].append(action_old)
+                if action_new:
+                    ep_batches[target][1].append(action_new)
+            elif cmd:
                 id = f'{pod_fqn}/{a_type}/{a_name}'
                 fns[id] = functools.partial(call,
                                             fn_name=f'exec_{cmd}_{a_type}',
@@ -234,7 +396,51 @@ async def update(s_old, s_new, logger=None, **kw):
                                             action_old=action_old,
                                             action_new=action_new,
                                             logger=logger)
-    await kopf.execute(fns=fns)
+        for target, (actions_old, actions_new) in ep_batches.items():
+            id = f'{pod_fqn}/dynamic_endpoint/{target}'
+            fns[id] = functools.partial(call,
+                                        fn_name='exec_batch_dynamic_endpoint',
+                                        s=s_new,
+                                        pod_fqn=pod_fqn,
+                                        action_old=actions_old,
+                                        action_new=actions_new,
+                                        logger=logger)
+    if direct:
+        await execute_directly(fns, logger)
+    else:
+        await kopf.execute(fns=fns)
+
+async def execute_directly(fns, logger, retries=5):
+    """Run FNS, the partials built by update(), without kopf.
+
+    The partials of a pod are run in order, the pods in parallel.  A
+    failed partial is retried like kopf would, but event handlers are
+    not retried, so after RETRIES attempts it is only logged.
+
+    """
+    async def run_pod_fns(pod_fns):
+        for id, fn in pod_fns:
+            for attempt in range(1, retries + 1):
+                try:
+                    await fn()
+                    break
+                except kopf.PermanentError as e:
+                    logger.error(f'{id} failed: {e}')
+                    break
+                except Exception as e:
+                    delay = getattr(e, 'delay', None) or 5 * attempt
+                    if attempt == retries:
+                        logger.error(f'{id} failed, giving up: {e!r}')
+                    else:
+                        logger.warning(f'{id} failed, retrying in '
+                                       f'{delay}s: {e!r}')
+                        await asyncio.sleep(delay)
+
+    by_pod = defaultdict(list)
+    for id, fn in fns.items():
+        by_pod[fn.keywords['pod_fqn']].append((id, fn))
+    await asyncio.gather(*(run_pod_fns(pod_fns)
+                           for pod_fns in by_pod.values()))
 
 async def call(fn_name, s, pod_fqn, action_old, action_new, logger, **kw):
     pod = s['pods'].get(pod_fqn)
@@ -488,6 +694,44 @@ async def exec_change_dynamic_endpoint(s, pod, action_old, action_new, logger):
     await exec_delete_dynamic_endpoint(s, pod, action_old, action_new, logger)
     await exec_add_dynamic_endpoint(s, pod, action_old, action_new, logger)
 
+async def exec_batch_dynamic_endpoint(s, pod, actions_old, actions_new, logger):
+    # Delete ACTIONS_OLD and add ACTIONS_NEW, all belonging to the same
+    # target, in a single request.
+    pname = pod['metadata']['name']
+    cname = (actions_new or actions_old)[0]['target']
+    if cname not in s['targets']:
+        # See exec_delete_dynamic_endpoint.
+        logger.info(f' skipping deletion as target {cname} does not exists')
+        actions_old = []
+        if not actions_new:
+            return
+
+    logger.info(f'configuring pod:{pname} for target:{cname}: '
+                f'add {len(actions_new)}, delete {len(actions_old)} d_endpoints')
+
+    l7mp_instance = get_l7mp_instance(pod)
+
+    body = {
+        'add': [{'name': a['name'], 'spec': a['spec']} for a in actions_new],
+        'delete': [a['name'] for a in actions_old],
+    }
+    try:
+        # Idempotent: endpoints already defined with the same spec
+        # (e.g., on resume) and endpoints already deleted are skipped.
+        l7mp_instance.update_end_points(cname, body, idempotent="true")
+    except l7mp_client.exceptions.ApiException as e:
+        # The batch is rejected as a whole, e.g., if an endpoint is
+        # defined with a different spec, or the proxy does not
+        # support batches.  Fall back to one call per endpoint.
+        logger.warning(f'batch update failed on pod:{pname} ({e.status}), '
+                       'falling back to per-endpoint calls')
+        for action in actions_old:
+            await exec_delete_dynamic_endpoint(s, pod, action, {}, logger)
+        for action in actions_new:
+            await exec_add_dynamic_endpoint(s, pod, {}, action, logger)
+    except urllib3.exceptions.MaxRetryError as e:
+        raise kopf.TemporaryError(f'{e}', delay=5)
+
 
 async def exec_add_rule(s, pod, _old, action, logger):
     rname = action['name']
@@ -559,6 +803,245 @@ async def exec_change_rule(s, pod, action_old, action_new, logger):
     await exec_add_rule(s, pod, action_old, action_new, logger)
 
 
+
+# Drift detection
+
+# Live objects are only compared if their names match the objects the
+# operator creates.  Auto-generated objects, e.g., the static
+# endpoints of a Target, have a different form.
+drift_name_patterns = {
+    'vsvc': re.compile(r'^/l7mp\.io/v1/VirtualService/[^/]+/[^/]+$'),
+    'target': re.compile(r'^/l7mp\.io/v1/Target/[^/]+/[^/]+$'),
+    'dynamic_endpoint': re.compile(r'^/l7mp\.io/v1/Target/[^/]+/[^/]+/[^/]+$'),
+    'rule': re.compile(r'^/l7mp\.io/v1/Rule/[^/]+/[^/]+$'),
+}
+
+def get_spec_digest(spec):
+    "Return a digest of SPEC, ignoring unset (None) values."
+    def strip(obj):
+        if isinstance(obj, dict):
+            return {k: strip(v) for k, v in obj.items() if v is not None}
+        if isinstance(obj, list):
+            return [strip(v) for v in obj]
+        return obj
+    normalized = json.dumps(strip(spec), sort_keys=True)
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+def get_rule_digest_spec(rule):
+    # The proxy replaces an inline route with the name of the route it
+    # generates, so routes are not compared.
+    action = rule.get('action') or {}
+    match = rule.get('match')
+    if match is None or match == '*':
+        match = {'match': '*'}
+    return {
+        'match': match,
+        'rewrite': action.get('rewrite'),
+        'apply': action.get('apply'),
+    }
+
+def get_action_fingerprint(action, logger, cache=None):
+    """Return the fingerprint of ACTION: a key and a spec digest.
+
+    The digest covers the part of the spec, as pushed to the proxy,
+    that the proxy returns verbatim in getConf.  The inline rules of a
+    listener are returned only as the name of the generated rulelist,
+    so they are not compared.
+
+    The digests of all but the dynamic endpoints are stored in CACHE,
+    these specs are the same for every pod within an action plan.
+
+    """
+    a_type = action['type']
+    key = (a_type, action['name'])
+    if a_type == 'dynamic_endpoint':
+        return key, get_spec_digest(action['spec'])
+    if cache is not None and key in cache:
+        return key, cache[key]
+    spec = action['spec']
+    if a_type == 'vsvc':
+        spec = convert_to_old_api(logger, 'virtualservices', spec)
+        spec = spec.get('listener', {}).get('spec')
+    elif a_type == 'target':
+        spec = convert_to_old_api(logger, 'targets', spec)
+        spec = spec.get('cluster', {}).get('spec')
+    elif a_type == 'rule':
+        spec = convert_to_old_api(logger, 'rules', spec)
+        spec = get_rule_digest_spec(spec.get('rule', {}))
+    digest = get_spec_digest(spec)
+    if cache is not None:
+        cache[key] = digest
+    return key, digest
+
+def get_conf_fingerprints(conf):
+    "Return the fingerprints of the operator-managed objects in CONF."
+    fps = {}
+    for a_type, key in (('vsvc', 'listeners'), ('target', 'clusters')):
+        for obj in conf.get(key) or []:
+            if drift_name_patterns[a_type].match(obj.get('name', '')):
+                fps[(a_type, obj['name'])] = get_spec_digest(obj.get('spec'))
+    for rule in conf.get('rules') or []:
+        if drift_name_patterns['rule'].match(rule.get('name', '')):
+            fps[('rule', rule['name'])] = get_spec_digest(
+                get_rule_digest_spec(rule))
+    for ep in conf.get('endpoints') or []:
+        if drift_name_patterns['dynamic_endpoint'].match(ep.get('name', '')):
+            fps[('dynamic_endpoint', ep['name'])] = get_spec_digest(
+                ep.get('spec'))
+    return fps
+
+def is_l7mp_ready(pod):
+    "Return True if the l7mp container of POD is ready."
+    for container in pod['status'].get('containerStatuses') or []:
+        if container.get('name') == 'l7mp':
+            return bool(container.get('ready'))
+    return False
+
+def get_live_conf(pod):
+    "Return the config running in POD as a dict."
+    l7mp_instance = get_l7mp_instance(pod)
+    # Sessions are left out, and the deserialization into model
+    # objects is skipped, only a few fields are needed.
+    response = l7mp_instance.get_conf(sessions='false',
+                                      _preload_content=False,
+                                      _request_timeout=10)
+    return json.loads(response.data)
+
+def get_drift_plan(s, logger):
+    "Return an action plan for S with a cache for the action digests."
+    plan = get_action_plan(s, logger)
+    plan['digests'] = {}
+    return plan
+
+def get_desired_fingerprints(s, plan, pod, logger):
+    desired = {}
+    digests = {}
+    for action in get_pod_actions(s, plan, pod).values():
+        key, digest = get_action_fingerprint(action, logger, plan['digests'])
+        desired[key] = action
+        digests[key] = digest
+    return desired, digests
+
+async def check_drift(s, pod, logger, plan=None):
+    """Compare the config of POD with the desired one, and repair it.
+
+    PLAN is returned by get_drift_plan(), it is shared by the pods of
+    a sweep, so the state is expanded only once per sweep.  If the
+    config differs from an old PLAN, the plan is rebuilt in place
+    before anything is repaired.
+
+    """
+    loop = asyncio.get_running_loop()
+    pod_fqn = get_fqn(pod)
+    try:
+        conf = await loop.run_in_executor(None, get_live_conf, pod)
+    except (l7mp_client.exceptions.ApiException,
+            urllib3.exceptions.HTTPError,
+            kopf.TemporaryError,
+            ValueError) as e:
+        logger.debug(f'drift check failed on pod:{pod_fqn}: {e}')
+        return
+    live = get_conf_fingerprints(conf)
+    if plan is not None:
+        desired, digests = get_desired_fingerprints(s, plan, pod, logger)
+        if digests == live:
+            return
+    else:
+        plan = {}
+    # The desired state is taken after the live one, so changes being
+    # pushed by the handlers right now show up only as missing objects.
+    plan.update(get_drift_plan(s, logger))
+    desired, digests = get_desired_fingerprints(s, plan, pod, logger)
+    if digests == live:
+        return
+
+    missing = [desired[key] for key in desired.keys() - live.keys()]
+    stale = live.keys() - desired.keys()
+    changed = [desired[key] for key in desired.keys() & live.keys()
+               if digests[key] != live[key]]
+    logger.info(f'drift on pod:{pod_fqn}: {len(missing)} missing, '
+                f'{len(stale)} stale, {len(changed)} changed objects')
+
+    rulelists = {}
+    for rulelist in conf.get('rulelists') or []:
+        for rule in rulelist.get('rules') or []:
+            rulelists[rule] = rulelist['name']
+    def get_live_action(a_type, name):
+        action = {'type': a_type, 'name': name}
+        if a_type == 'dynamic_endpoint':
+            action['target'] = name.rsplit('/', 1)[0]
+        elif a_type == 'rule':
+            if name not in rulelists:
+                logger.warning(f'no rulelist for rule:{name}')
+                return None
+            action['spec'] = {'rulelist': rulelists[name]}
+        return action
+
+    stale_actions = [a for a in (get_live_action(*key) for key in stale) if a]
+    changes = []
+    for action in changed:
+        if action['type'] == 'dynamic_endpoint':
+            # Re-added in one batch with the missing endpoints.
+            stale_actions.append(get_live_action('dynamic_endpoint',
+                                                 action['name']))
+            missing.append(action)
+            continue
+        old = get_live_action(action['type'], action['name'])
+        if old:
+            changes.append((old, action))
+    # Changing a target re-creates the cluster, so its endpoints must
+    # be added again.
+    changed_targets = {a['name'] for _, a in changes if a['type'] == 'target'}
+    missing += [a for a in desired.values()
+                if a['type'] == 'dynamic_endpoint'
+                and a['target'] in changed_targets and a not in missing]
+
+    # Delete first, so that an endpoint with a changed address can be
+    # re-added with the same name.
+    order = ['rule', 'dynamic_endpoint', 'target', 'vsvc']
+    await repair_drift(s, pod, stale_actions, order, 'delete', logger)
+    for old, new in changes:
+        await globals()[f'exec_change_{new["type"]}'](s, pod, old, new, logger)
+    await repair_drift(s, pod, missing, order[::-1], 'add', logger)
+
+async def repair_drift(s, pod, actions, order, cmd, logger):
+    ep_batches = defaultdict(list)
+    for a_type in order:
+        for action in actions:
+            if action['type'] != a_type:
+                continue
+            if a_type == 'dynamic_endpoint':
+                ep_batches[action['target']].append(action)
+            elif cmd == 'add':
+                await globals()[f'exec_add_{a_type}'](s, pod, {}, action, logger)
+            else:
+                await globals()[f'exec_delete_{a_type}'](s, pod, action, {}, logger)
+        if a_type == 'dynamic_endpoint':
+            for batch in ep_batches.values():
+                if cmd == 'add':
+                    await exec_batch_dynamic_endpoint(s, pod, [], batch, logger)
+                else:
+                    await exec_batch_dynamic_endpoint(s, pod, batch, [], logger)
+
+async def drift_check_fn(logger):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        plan = None
+        for pod_fqn in list(s['pods'].keys()):
+            pod = s['pods'].get(pod_fqn)
+            if not pod or not is_l7mp_ready(pod):
+                continue
+            try:
+                if plan is None:
+                    plan = get_drift_plan(s, logger)
+                await check_drift(s, pod, logger, plan)
+            except Exception as e:
+                logger.warning(f'drift repair failed on pod:{pod_fqn}: {e}')
+            await asyncio.sleep(1 / DRIFT_CHECK_RATE)
+        await asyncio.sleep(max(0, DRIFT_CHECK_INTERVAL -
+                                (loop.time() - started)))
+
 
 # K8s API watchers
 
@@ -569,14 +1052,31 @@ def fail_if_pod_not_ready(o_type, body, **kw):
         raise kopf.TemporaryError(f'No podIP in {kw["name"]}', delay=3)
 
 
+drift_check_task = None
+
 @kopf.on.startup()
-def startup_fn(settings: kopf.OperatorSettings, logger, **kw):
+async def startup_fn(settings: kopf.OperatorSettings, logger, **kw):
+    global drift_check_task
     settings.persistence.finalizer = 'operator.l7mp.io/kopf-finalizer'
     settings.persistence.progress_storage = kopf.AnnotationsProgressStorage(
         prefix='operator.l7mp.io')
     settings.persistence.diffbase_storage = kopf.AnnotationsDiffBaseStorage(
         prefix='operator.l7mp.io',
     )
+    if DRIFT_CHECK_INTERVAL > 0:
+        drift_check_task = asyncio.create_task(drift_check_fn(logger))
+        drift_check_task.add_done_callback(
+            lambda task: task.cancelled() or not task.exception() or
+            logger.error(f'drift check stopped: {task.exception()!r}'))
+
+@kopf.on.cleanup()
+async def cleanup_fn(logger, **kw):
+    if drift_check_task:
+        drift_check_task.cancel()
+    if node_resync_handle:
+        node_resync_handle.cancel()
+    if node_resync_task:
+        node_resync_task.cancel()
 
 @kopf.on.field('', 'v1', 'pods', field='status.containerStatuses')
 async def pod_status_fn(new, body, logger, **kw):
@@ -602,8 +1102,6 @@ async def pod_status_fn(new, body, logger, **kw):
 
 @kopf.on.create('', 'v1', 'pods')
 @kopf.on.resume('', 'v1', 'pods')
-@kopf.on.create('', 'v1', 'endpoints')
-@kopf.on.resume('', 'v1', 'endpoints')
 @kopf.on.create('l7mp.io', 'v1', 'virtualservices')
 @kopf.on.resume('l7mp.io', 'v1', 'virtualservices')
 @kopf.on.create('l7mp.io', 'v1', 'targets')
@@ -623,7 +1121,6 @@ async def create_fn(body, **kw):
 
 
 @kopf.on.delete('', 'v1', 'pods')
-@kopf.on.delete('', 'v1', 'endpoints')
 @kopf.on.delete('l7mp.io', 'v1', 'virtualservices')
 @kopf.on.delete('l7mp.io', 'v1', 'targets')
 @kopf.on.delete('l7mp.io', 'v1', 'rules')
@@ -640,7 +1137,6 @@ async def delete_fn(body, old, **kw):
 
 
 @kopf.on.update('', 'v1', 'pods')
-@kopf.on.update('', 'v1', 'endpoints')
 @kopf.on.update('l7mp.io', 'v1', 'virtualservices')
 @kopf.on.update('l7mp.io', 'v1', 'targets')
 @kopf.on.update('l7mp.io', 'v1', 'rules')
@@ -658,6 +1154,152 @@ async def update_fn(body, old, **kw):
 
     await update(s_old, s, body=body, old=old, **kw)
 
+
+if ENDPOINTS_SOURCE == 'endpoints':
+    kopf.on.create('', 'v1', 'endpoints')(create_fn)
+    kopf.on.resume('', 'v1', 'endpoints')(create_fn)
+    kopf.on.delete('', 'v1', 'endpoints')(delete_fn)
+    kopf.on.update('', 'v1', 'endpoints')(update_fn)
+
+
+def get_endpointslice_members(body):
+    "Return the uids of the ready pods listed in endpointslice BODY."
+    members = set()
+    for ep in body.get('endpoints') or []:
+        # A missing ready condition should be interpreted as ready.
+        if ep.get('conditions', {}).get('ready') is False:
+            continue
+        target_ref = ep.get('targetRef') or {}
+        if target_ref.get('kind') == 'Pod' and target_ref.get('uid'):
+            members.add(target_ref['uid'])
+    return frozenset(members)
+
+async def endpointslice_fn(event, body, logger, **kw):
+    # EndpointSlices are watched with a plain event handler, so that
+    # kopf stores no progress annotations on them, and only the
+    # membership of a single slice is updated here instead of the
+    # whole service.  As event handlers are not retried, the changes
+    # are pushed directly, with retries of their own.
+    labels = body.get('metadata', {}).get('labels', {})
+    if not labels.get('kubernetes.io/service-name'):
+        return
+    service = (body['metadata']['namespace'],
+               labels['kubernetes.io/service-name'])
+    fqn = get_fqn(body)
+    if event.get('type') == 'DELETED':
+        members = frozenset()
+    else:
+        members = get_endpointslice_members(body)
+    old_members = s['services'].get(service, {}).get(fqn, frozenset())
+    if members == old_members:
+        return
+
+    # Only the membership of SERVICE changes, so there is no need to
+    # copy the rest of the state.
+    s_old = dict(s)
+    s_old['services'] = defaultdict(dict, s['services'])
+    slices = dict(s['services'].get(service, {}))
+    if members:
+        slices[fqn] = members
+    else:
+        slices.pop(fqn, None)
+    if slices:
+        s['services'][service] = slices
+    else:
+        s['services'].pop(service, None)
+
+    await update(s_old, s, logger=logger, service=service, direct=True, **kw)
+
+if ENDPOINTS_SOURCE == 'endpointslices':
+    kopf.on.event('discovery.k8s.io', 'v1', 'endpointslices')(endpointslice_fn)
+
+
+def has_zone_locality(s):
+    return any(t['spec'].get('locality') == 'Zone'
+               for t in s['targets'].values())
+
+# Seconds without a node in the initial listing before Targets are
+# resynced.
+NODE_RESYNC_DELAY = 2
+node_resync_handle = None
+node_resync_task = None
+
+def schedule_node_resync(logger):
+    global node_resync_handle
+    if node_resync_handle:
+        node_resync_handle.cancel()
+    loop = asyncio.get_running_loop()
+    node_resync_handle = loop.call_later(NODE_RESYNC_DELAY,
+                                         start_node_resync, logger)
+
+def start_node_resync(logger):
+    global node_resync_task
+    node_resync_task = asyncio.create_task(node_resync_fn(logger))
+
+async def node_resync_fn(logger):
+    # Pods and Targets may have been resumed before the zones of their
+    # nodes were known, so they got all the endpoints or only some of
+    # the local ones.  Every local endpoint is added and every other
+    # one deleted, both are no-ops on the proxy where already done.
+    zone_targets = {get_fqn(t) for t in s['targets'].values()
+                    if t['spec'].get('locality') == 'Zone'}
+    if not zone_targets:
+        return
+    logger.info(f'initial node list loaded ({len(s["nodes"])} nodes), '
+                'resyncing Targets')
+    s_nozones = dict(s)
+    s_nozones['nodes'] = {}
+    a_all = get_actions(s_nozones, logger)
+    a_local = get_actions(s, logger)
+    fns = {}
+    for pod_fqn, actions in a_local.items():
+        ep_batches = defaultdict(lambda: ([], []))
+        for action in actions.values():
+            if (action['type'] == 'dynamic_endpoint' and
+                action['target'] in zone_targets):
+                ep_batches[action['target']][1].append(action)
+        for key, action in a_all.get(pod_fqn, {}).items():
+            if (action['type'] == 'dynamic_endpoint' and
+                action['target'] in zone_targets and key not in actions):
+                ep_batches[action['target']][0].append(action)
+        for target, (actions_old, actions_new) in ep_batches.items():
+            id = f'{pod_fqn}/dynamic_endpoint/{target}'
+            fns[id] = functools.partial(call,
+                                        fn_name='exec_batch_dynamic_endpoint',
+                                        s=s,
+                                        pod_fqn=pod_fqn,
+                                        action_old=actions_old,
+                                        action_new=actions_new,
+                                        logger=logger)
+    await execute_directly(fns, logger)
+
+@kopf.on.event('', 'v1', 'nodes')
+async def node_fn(event, body, logger, **kw):
+    # Only the zone of the nodes is tracked, for Targets with Zone
+    # locality.
+    name = body['metadata']['name']
+    zone = body['metadata'].get('labels', {}).get(ZONE_LABEL)
+    if event.get('type') is None:
+        # Initial listing: the Targets are resynced once, after the
+        # last node, instead of once per node.
+        s['nodes'][name] = zone
+        schedule_node_resync(logger)
+        return
+    deleted = event.get('type') == 'DELETED'
+    if deleted and name not in s['nodes']:
+        return
+    if not deleted and name in s['nodes'] and s['nodes'][name] == zone:
+        return
+    s_old = dict(s)
+    s_old['nodes'] = dict(s['nodes'])
+    if deleted:
+        del s['nodes'][name]
+    else:
+        s['nodes'][name] = zone
+    if not has_zone_locality(s):
+        return
+    await update(s_old, s, logger=logger, direct=True, **kw)
+
 
 # Selectors
 
@@ -678,21 +1320,22 @@ def does_operator_match(value, operator, values):
         raise kopf.PermanentError(f'Unkown operator: {expr["operator"]}')
     return True
 
-def does_selector_match(s, selector, pod):
+def does_selector_match(s, selector, pod, namespace=None):
+    "Return True if POD matches SELECTOR of an object in NAMESPACE."
     match = True
     for k, v in selector.items():
         fn = f'does_selector_match__{k}'
         if fn in globals():
-            match = match and globals()[fn](s, v, pod)
+            match = match and globals()[fn](s, v, pod, namespace)
         else:
             raise kopf.PermanentError(f'Selector not supported: {k}')
     return match
 
-def does_selector_match__matchLabels(_s, args, pod):
+def does_selector_match__matchLabels(_s, args, pod, _namespace):
     labels = pod.get('metadata', {}).get('labels', {})
     return all(v == labels.get(k) for k, v in args.items())
 
-def does_selector_match__matchExpressions(_s, args, pod):
+def does_selector_match__matchExpressions(_s, args, pod, _namespace):
     labels = pod.get('metadata', {}).get('labels', {})
     for expr in args:
         value = labels.get(expr['key'])
@@ -700,7 +1343,7 @@ def does_selector_match__matchExpressions(_s, args, pod):
             return False
     return True
 
-def does_selector_match__matchFields(_s, args, pod):
+def does_selector_match__matchFields(_s, args, pod, _namespace):
     for expr in args:
         value = pod
         for key in expr['key'].split('.'):
@@ -711,19 +1354,24 @@ def does_selector_match__matchFields(_s, args, pod):
             return False
     return True
 
-def does_selector_match__matchNamespace(_s, args: str, pod):
+def does_selector_match__matchNamespace(_s, args: str, pod, _namespace):
     return args == pod.get('metadata', {}).get('namespace')
 
-def does_selector_match__matchService(_s, service, pod):
+def does_selector_match__matchService(s, service, pod, namespace):
+    pod_uid = pod.get('metadata', {}).get('uid')
+    if not pod_uid:
+        return False
+    if ENDPOINTS_SOURCE == 'endpointslices':
+        # The service is looked up in the namespace of the object
+        # holding the selector.
+        slices = s['services'].get((namespace, service), {})
+        return any(pod_uid in members for members in slices.values())
     for ep in s['endpoints'].values():
         if ep['metadata']['name'] == service:
             service_ep = ep
             break
     else:
         return False
-    pod_uid = pod.get('metadata', {}).get('uid')
-    if not pod_uid:
-        return False
     for subset in service_ep.get('subsets', {}):
         for addr in subset.get('addresses', {}):
             uid = addr.get('targetRef', {}).get('uid')
@@ -734,10 +1382,11 @@ def does_selector_match__matchService(_s, service, pod):
 def iter_matching(s, objects, pod):
     for obj in objects.values():
         selector = obj['spec']['selector']
-        if does_selector_match(s, selector, pod):
+        namespace = obj['metadata']['namespace']
+        if does_selector_match(s, selector, pod, namespace):
             yield obj
 
-def iter_matching_pods(s, selector, pods_to_search):
+def iter_matching_pods(s, selector, pods_to_search, namespace=None):
     for pod in pods_to_search.values():
-        if does_selector_match(s, selector, pod):
+        if does_selector_match(s, selector, pod, namespace):
             yield pod
@@ -58,8 +58,9 @@ class L7mpOpenAPI {
         // general config API
         this.api.registerHandler('getConf', (ctx, req, res) => {
             log.info("L7mp.api.getConf");
+            let sessions = ctx.request.query.sessions !== 'false';
             // cannot be recursive
-            res.status = new Response(l7mp.dumpL7mp());
+            res.status = new Response(l7mp.dumpL7mp({sessions: sessions}));
         });
 
         this.api.registerHandler('getAdmin', (ctx, req, res) => {
@@ -191,6 +192,22 @@ class L7mpOpenAPI {
             }
         });
 
+        this.api.registerHandler('updateEndPoints', async (ctx, req, res) => {
+            log.info("L7mp.api.updateEndPoints");
+            let recursive = ctx.request.query.recursive === 'true' ?
+                ctx.request.query.recursive : false;
+            let idempotent = ctx.request.query.idempotent === 'true' ?
+                ctx.request.query.idempotent : false;
+            try {
+                let result = await l7mp.updateEndPoints(ctx.request.params.name, req.body,
+                                                        {recursive: recursive,
+                                                         idempotent: idempotent});
+                res.status = new Ok();
+            } catch(err){
+                res.status = new BadRequestError(err.message);
+            }
+        });
+
         this.api.registerHandler('deleteEndPoint', (ctx, req, res) => {
             log.info("L7mp.api.deleteEndPoint");
             let recursive = ctx.request.query.recursive === 'true' ?
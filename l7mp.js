@@ -103,9 +103,10 @@ class L7mp {
     }
 
     dumpL7mp(options) {
+        options = {sessions: true, ...options};
         log.silly('L7mp.dumpL7mp:', `"${this.name}"`);
 
-        return {
+        let conf = {
             admin:      this.getAdmin(),
             listeners:  this.listeners.map( l => this.dumpListener(l.name)),
             clusters:   this.clusters.map(  c => this.dumpCluster(c.name)),
@@ -113,8 +114,12 @@ class L7mp {
             rules:      this.rules.map(     r => this.dumpRule(r.name)),
             routes:     this.routes.map(    r => this.dumpRoute(r.name)),
             endpoints:  this.endpoints.map( e => this.dumpEndPoint(e.name)),
-            sessions:   this.sessions.map(s => s.toJSON()),
         };
+        // sessions may be many, leave them out if not needed
+        if(options.sessions)
+            conf.sessions = this.sessions.map(s => s.toJSON());
+
+        return conf;
     }
 
     newName(name, find){
@@ -1022,6 +1027,92 @@ class L7mp {
         return ep;
     }
 
+    // add and delete a list of endpoints to/from a cluster in one step: the whole batch is
+    // validated and the new endpoints are created first, and only then applied to the cluster,
+    // so that the load-balancer is updated only once per batch; with options.idempotent, adds of
+    // endpoints that already exist in the cluster with the same spec and deletes of unknown
+    // endpoints are skipped
+    async updateEndPoints(c, batch, options){
+        options = {recursive: false, idempotent: false, ...options};
+        log.silly('L7mp.updateEndPoints:', c, dumper(batch, 6),
+                  'options:', dumper(options, 4));
+
+        let cl = this.getCluster(c);
+        if(!cl){
+            let e = `Unknown cluster "${c}"`;
+            log.warn('L7mp.updateEndPoints', e);
+            throw new NotFoundError(`Cannot update endpoints: ${e}`);
+        }
+
+        let deleted = new Set();
+        for(let n of batch.delete || []){
+            let ep = cl.getEndPoint(n);
+            if((!ep || deleted.has(n)) && options.idempotent)
+                continue;
+            if(!ep || deleted.has(n)){
+                let e = `Unknown endpoint "${n}"`;
+                log.warn('L7mp.updateEndPoints', e);
+                throw new NotFoundError(`Cannot update endpoints: ${e}`);
+            }
+            deleted.add(n);
+        }
+
+        let schema = {
+            name: {
+                validate: (value) => /^\S+?$/.test(value),
+            },
+            spec: {
+                validate: (value) => value instanceof Object,
+                required: true,
+            },
+        };
+
+        let adds = [];
+        let added = new Set();
+        for(let ep of batch.add || []){
+            let e = validate(ep, schema);
+            let existing = !e && ep.name && !deleted.has(ep.name) && this.getEndPoint(ep.name);
+            if(existing && options.idempotent && existing.cluster === cl &&
+               util.isDeepStrictEqual(existing.spec, ep.spec))
+                continue;
+            if(!e && ep.name && (added.has(ep.name) || existing))
+                e = `Endpoint "${ep.name}" already defined`;
+            if(e){
+                log.warn('L7mp.updateEndPoints:', e);
+                throw new Error(`Cannot update endpoints: ${e}`);
+            }
+            added.add(ep.name);
+            adds.push(ep);
+        }
+
+        // create the endpoints before changing anything: this may still fail
+        for(let ep of adds)
+            ep.name = ep.name ||
+                this.newName(`${cl.name}-EndPoint-${EndPoint.index++}`,
+                             this.getEndPoint);
+        let eps;
+        try {
+            eps = adds.map(ep => EndPoint.create(cl, ep));
+        } catch(err){
+            log.warn('L7mp.updateEndPoints:', err.message);
+            throw new Error(`Cannot update endpoints: ${err.message}`);
+        }
+
+        if(deleted.size > 0){
+            cl.deleteEndPoints(deleted);
+            this.endpoints = this.endpoints.filter(({name}) => !deleted.has(name));
+            if(options.recursive)
+                this.disconnectEndPoints(cl, deleted);
+        }
+
+        if(eps.length > 0){
+            cl.addEndPoints(eps);
+            this.endpoints.push(...eps);
+        }
+
+        return eps;
+    }
+
     getEndPoint(n){
         log.silly('L7mp.getEndPoint:', n);
         return this.endpoints.find( ({name}) => name === n );
@@ -1063,32 +1154,7 @@ class L7mp {
             this.endpoints.splice(i, 1);
 
             if(options.recursive)
-                for(let s of this.sessions){
-                    if(s.destination.endpoint && s.destination.endpoint.name === n)
-                        // note: s.disconnect returns a promise but we don't want to wait for it to
-                        // be resolved: just call without await
-                        s.disconnect(s.destination, new Ok(`Traversed EndPoint ${n} of destination `+
-                                                           `cluster ${cl.name} is deleted from API`)).
-                        catch(err => { /* ignore error silently: disconnect logs what's needed */ });
-
-
-                    let stages = s.chain.ingress.filter(_stage => _stage.endpoint.name === n);
-                    for(let stage of stages)
-                        // note: s.disconnect returns a promise but we don't want to wait for it to
-                        // be resolved: just call without await
-                        s.disconnect(stage, new Ok(`Traversed EndPoint ${n} of Cluster ${cl.name} `+
-                                                   `on the ingress chain is deleted from API`)).
-                        catch(err => { /* ignore error silently: disconnect logs what's needed */ });
-
-                    stages = s.chain.egress.filter(_stage => _stage.endpoint.name === n);
-                    for(let stage of stages)
-                        // note: s.disconnect returns a promise but we don't want to wait for it to
-                        // be resolved: just call without await
-                        s.disconnect(stage, new Ok(`Traversed EndPoint ${n} of Cluster ${cl.name} `+
-                                                   `on the egress chain is deleted from API`)).
-                        catch(err => { /* ignore error silently: disconnect logs what's needed */ });
-
-                }
+                this.disconnectEndPoints(cl, new Set([n]));
 
         } else {
             let e = `Unknown endpoint "${n}"`;
@@ -1097,6 +1163,34 @@ class L7mp {
         }
     }
 
+    // internal: disconnect the sessions traversing the endpoints in the set NS of cluster CL
+    disconnectEndPoints(cl, ns){
+        for(let s of this.sessions){
+            if(s.destination.endpoint && ns.has(s.destination.endpoint.name))
+                // note: s.disconnect returns a promise but we don't want to wait for it to
+                // be resolved: just call without await
+                s.disconnect(s.destination, new Ok(`Traversed EndPoint ${s.destination.endpoint.name} `+
+                                                   `of destination cluster ${cl.name} is deleted from API`)).
+                catch(err => { /* ignore error silently: disconnect logs what's needed */ });
+
+            let stages = s.chain.ingress.filter(_stage => ns.has(_stage.endpoint.name));
+            for(let stage of stages)
+                // note: s.disconnect returns a promise but we don't want to wait for it to
+                // be resolved: just call without await
+                s.disconnect(stage, new Ok(`Traversed EndPoint ${stage.endpoint.name} of Cluster ${cl.name} `+
+                                           `on the ingress chain is deleted from API`)).
+                catch(err => { /* ignore error silently: disconnect logs what's needed */ });
+
+            stages = s.chain.egress.filter(_stage => ns.has(_stage.endpoint.name));
+            for(let stage of stages)
+                // note: s.disconnect returns a promise but we don't want to wait for it to
+                // be resolved: just call without await
+                s.disconnect(stage, new Ok(`Traversed EndPoint ${stage.endpoint.name} of Cluster ${cl.name} `+
+                                           `on the egress chain is deleted from API`)).
+                catch(err => { /* ignore error silently: disconnect logs what's needed */ });
+        }
+    }
+
     ////////////////////////////////////////////////////
     //
     // Session API
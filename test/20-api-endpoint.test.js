@@ -298,6 +298,104 @@ describe('EndPoint API', ()  => {
             return Promise.resolve();
         });
     });
+    context('batch-add-delete-endpoints', ()=>{
+        let res;
+        let options = {
+            host: 'localhost', port: 1234,
+            path: '/api/v1/clusters/test-cluster/endpoints/batch', method: 'POST',
+            headers: {'Content-Type': 'application/json'}
+        };
+        let options_get = {
+            host: 'localhost', port: 1234,
+            path: '/api/v1/clusters/test-cluster/endpoints',
+            method: 'GET'
+        };
+        it('add-5-endpoints', async ()=>{
+            let add = [];
+            for(let i = 1; i < 6; i++)
+                add.push({name: `test-cluster-EndPoint-${i}`,
+                          spec: { port: 15000 + i, address: '127.0.0.1'}});
+            let b_res = await httpRequest(options, JSON.stringify({add: add}));
+            assert.nestedPropertyVal(b_res, 'status', 200);
+            res = await httpRequest(options_get);
+            assert.lengthOf(res, 5);
+            return Promise.resolve();
+        });
+        it('check-endpoint-1', ()=>{ assert.isOk(res.find( ({name}) => name ===  'test-cluster-EndPoint-1'));});
+        it('check-endpoint-5', ()=>{ assert.isOk(res.find( ({name}) => name ===  'test-cluster-EndPoint-5'));});
+        it('add-and-delete-endpoints', async ()=>{
+            const postData = JSON.stringify({
+                add: [{name: 'test-cluster-EndPoint-6', spec: { port: 15006, address: '127.0.0.1'}}],
+                delete: ['test-cluster-EndPoint-1', 'test-cluster-EndPoint-2'],
+            });
+            let b_res = await httpRequest(options, postData);
+            assert.nestedPropertyVal(b_res, 'status', 200);
+            res = await httpRequest(options_get);
+            assert.lengthOf(res, 4);
+            return Promise.resolve();
+        });
+        it('check-endpoint-1-deleted', ()=>{ assert.isNotOk(res.find( ({name}) => name ===  'test-cluster-EndPoint-1'));});
+        it('check-endpoint-6', ()=>{ assert.isOk(res.find( ({name}) => name ===  'test-cluster-EndPoint-6'));});
+        it('add-existing-endpoint-fails', async ()=>{
+            const postData = JSON.stringify({
+                add: [{name: 'test-cluster-EndPoint-7', spec: { port: 15007, address: '127.0.0.1'}},
+                      {name: 'test-cluster-EndPoint-3', spec: { port: 15003, address: '127.0.0.1'}}],
+            });
+            await httpRequest(options, postData)
+                .then(
+                    ()=>{ return Promise.reject(new Error('Expected method to reject.'))},
+                    err => { assert.instanceOf(err, Error); return Promise.resolve()}
+                );
+        });
+        it('failed-batch-not-applied', async ()=>{
+            res = await httpRequest(options_get);
+            assert.lengthOf(res, 4);
+            return Promise.resolve();
+        });
+        it('delete-non-existent-endpoint-fails', async ()=>{
+            const postData = JSON.stringify({
+                delete: ['test-cluster-EndPoint-3', 'non-existent-endpoint'],
+            });
+            await httpRequest(options, postData)
+                .then(
+                    ()=>{ return Promise.reject(new Error('Expected method to reject.'))},
+                    err => { assert.instanceOf(err, Error); return Promise.resolve()}
+                );
+        });
+        it('idempotent-add-existing-and-delete-non-existent', async ()=>{
+            const postData = JSON.stringify({
+                add: [{name: 'test-cluster-EndPoint-3', spec: { port: 15003, address: '127.0.0.1'}},
+                      {name: 'test-cluster-EndPoint-7', spec: { port: 15007, address: '127.0.0.1'}}],
+                delete: ['non-existent-endpoint'],
+            });
+            let b_res = await httpRequest({...options, path: `${options.path}?idempotent=true`},
+                                          postData);
+            assert.nestedPropertyVal(b_res, 'status', 200);
+            res = await httpRequest(options_get);
+            assert.lengthOf(res, 5);
+            return Promise.resolve();
+        });
+        it('idempotent-add-existing-with-different-spec-fails', async ()=>{
+            const postData = JSON.stringify({
+                add: [{name: 'test-cluster-EndPoint-3', spec: { port: 16003, address: '127.0.0.1'}}],
+            });
+            await httpRequest({...options, path: `${options.path}?idempotent=true`}, postData)
+                .then(
+                    ()=>{ return Promise.reject(new Error('Expected method to reject.'))},
+                    err => { assert.instanceOf(err, Error); return Promise.resolve()}
+                );
+        });
+        it('delete-all-endpoints', async ()=>{
+            const postData = JSON.stringify({
+                delete: res.map(({name}) => name),
+            });
+            let b_res = await httpRequest(options, postData);
+            assert.nestedPropertyVal(b_res, 'status', 200);
+            res = await httpRequest(options_get);
+            assert.lengthOf(res, 0);
+            return Promise.resolve();
+        });
+    });
     context('invalid-request',()=>{
         it('add-endpoint-validation-fail', async ()=>{
             const postData = JSON.stringify({
@@ -121,6 +121,19 @@ describe('Admin API', ()  => {
                                           'rulelists', 'rules', 'routes', 'sessions']);
             return Promise.resolve();
         });
+        it('get-config-without-sessions', async ()=>{
+            let res;
+            let options = {
+                host: 'localhost', port: '1234',
+                path: '/api/v1/config?sessions=false',
+                method : 'GET',
+            };
+            res = await httpRequest(options);
+            assert.containsAllKeys(res, ['admin','listeners','clusters',
+                                          'rulelists', 'rules', 'routes', 'endpoints']);
+            assert.notProperty(res, 'sessions');
+            return Promise.resolve();
+        });
         it('get-admin', async ()=>{
             let res;
             let options = {